@@ -1,15 +1,119 @@
-from fastapi import APIRouter, UploadFile, File, Form
-from app.services.summarize import run_pipeline
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Response
+from app.services.summarize import run_pipeline, run_pipeline_from_array
+from functools import partial
 from pathlib import Path
 from typing import Optional
-import shutil
+from collections import OrderedDict
+import asyncio
+import time
+import numpy as np
 import uuid
 import os
-import json
+import orjson
 import tempfile
 
 router = APIRouter()
 
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# containers FFmpeg can demux from a non-seekable pipe (MP4/MOV/M4A keep their index at the end)
+STREAMABLE_TYPES = [".mp3", ".wav", ".flac", ".ogg", ".mkv"]
+
+# at most this many pipelines run at once; further requests wait for a free slot
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+_job_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+# in-memory job registry for /jobs, keyed by job id
+_jobs = {}
+_job_tasks = set()
+# finished jobs (job id -> finish time), oldest first; results are dropped after JOB_RESULT_TTL
+# seconds, or earlier once more than MAX_FINISHED_JOBS are kept
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "100"))
+_finished_jobs = OrderedDict()
+
+def _evict_finished_jobs():
+    expired_before = time.monotonic() - JOB_RESULT_TTL
+    while _finished_jobs:
+        job_id, finished_at = next(iter(_finished_jobs.items()))
+        if finished_at >= expired_before and len(_finished_jobs) <= MAX_FINISHED_JOBS:
+            break
+        del _finished_jobs[job_id]
+        _jobs.pop(job_id, None)
+
+async def _save_upload(file: UploadFile) -> str:
+    temp_dir = tempfile.gettempdir()
+    temp_filename = os.path.join(temp_dir, f"{uuid.uuid4()}_{file.filename}")
+    # copy the upload in fixed-size chunks, writing each on a worker thread so a slow disk doesn't stall the event loop
+    with open(temp_filename, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await asyncio.to_thread(f.write, chunk)
+    return temp_filename
+
+async def _decode_upload(file: UploadFile):
+    """
+    Pipe the upload through FFmpeg into 16 kHz mono float32 samples, without copying it to a temp file of our own.
+    Returns None if FFmpeg can't decode it; raises FileNotFoundError if FFmpeg isn't installed.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'error', '-threads', '0',
+        '-i', 'pipe:0',
+        '-vn',
+        '-f', 'f32le',
+        '-ac', '1',
+        '-ar', '16000',
+        'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    async def feed():
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # FFmpeg stopped reading; its exit code says why
+        finally:
+            process.stdin.close()
+
+    # feed stdin while draining stdout/stderr so neither side blocks on a full pipe
+    _, pcm, stderr = await asyncio.gather(feed(), process.stdout.read(), process.stderr.read())
+    if await process.wait() != 0:
+        print(f"Error decoding upload with FFmpeg: {file.filename}")
+        print(f"FFmpeg stderr: {stderr.decode()}")
+        return None
+    return np.frombuffer(pcm, dtype=np.float32)
+
+async def _run_blocking(func, **kwargs) -> dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, **kwargs))
+
+async def _run_limited(func, **kwargs) -> dict:
+    """
+    Run a blocking pipeline function on a worker thread once a concurrency slot is free.
+    """
+    async with _job_semaphore:
+        return await _run_blocking(func, **kwargs)
+
+async def _run_pipeline_limited(temp_filename: str, **options) -> dict:
+    return await _run_limited(run_pipeline, input_file=Path(temp_filename), **options)
+
+async def _run_job(job_id: str, temp_filename: str, options: dict):
+    try:
+        _jobs[job_id]["status"] = "running"
+        _jobs[job_id]["result"] = await _run_pipeline_limited(temp_filename, **options)
+        _jobs[job_id]["status"] = "completed"
+    except Exception as e:
+        _jobs[job_id]["status"] = "failed"
+        _jobs[job_id]["result"] = {"error": str(e)}
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        _finished_jobs[job_id] = time.monotonic()
+        _evict_finished_jobs()
+
 @router.post("/process")
 async def process_file(
     file: UploadFile = File(...),
@@ -19,16 +123,33 @@ async def process_file(
     transcriber_model: str = Form("small"),
     chunk_size: int = Form(2000),
     language: Optional[str] = Form(None)
-):  
-    temp_dir = tempfile.gettempdir()
-    temp_filename = os.path.join(temp_dir, f"{uuid.uuid4()}_{file.filename}")
-    
-    try:
-        with open(temp_filename, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+):
+    # Without enhancement nothing needs a named file: FastAPI has already spooled the upload, so decode
+    # straight from there instead of copying it to another temp file first. The decode holds a job slot
+    # too, since each FFmpeg process buffers the whole decoded track.
+    if not (denoise or aggressive_denoise) and Path(file.filename or "").suffix.lower() in STREAMABLE_TYPES:
+        async with _job_semaphore:
+            try:
+                audio = await _decode_upload(file)
+            except FileNotFoundError:
+                pass  # no FFmpeg on PATH, nothing consumed yet: use the file-based pipeline
+            else:
+                if audio is None:
+                    return {"error": "Audio decoding failed"}
+                return await _run_blocking(
+                    run_pipeline_from_array,
+                    audio=audio,
+                    source_name=file.filename,
+                    transcriber_model=transcriber_model,
+                    chunk_size=chunk_size,
+                    language=language
+                )
 
-        result = run_pipeline(
-            input_file=Path(temp_filename),
+    temp_filename = None
+    try:
+        temp_filename = await _save_upload(file)
+        result = await _run_pipeline_limited(
+            temp_filename,
             denoise=denoise,
             aggressive_denoise=aggressive_denoise,
             force_wav=force_wav,
@@ -38,16 +159,66 @@ async def process_file(
         )
         return result
     finally:
-        if os.path.exists(temp_filename):
+        if temp_filename and os.path.exists(temp_filename):
             os.remove(temp_filename)
 
+@router.post("/jobs")
+async def submit_job(
+    file: UploadFile = File(...),
+    denoise: bool = Form(False),
+    aggressive_denoise: bool = Form(False),
+    force_wav: bool = Form(False),
+    transcriber_model: str = Form("small"),
+    chunk_size: int = Form(2000),
+    language: Optional[str] = Form(None)
+):
+    temp_filename = await _save_upload(file)
+    job_id = str(uuid.uuid4())
+    _jobs[job_id] = {"job_id": job_id, "status": "queued", "result": None}
+
+    options = dict(
+        denoise=denoise,
+        aggressive_denoise=aggressive_denoise,
+        force_wav=force_wav,
+        transcriber_model=transcriber_model,
+        chunk_size=chunk_size,
+        language=language
+    )
+    task = asyncio.create_task(_run_job(job_id, temp_filename, options))
+    # keep a reference so the task isn't garbage collected before it finishes
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    return {"job_id": job_id, "status": "queued"}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    _evict_finished_jobs()
+    if job_id not in _jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _jobs[job_id]
+
 @router.get("/logs")
 def get_logs():
-    try:
-        with open("logs/apps.json", "r") as f:
-            data = json.load(f)
-        return data
-    except FileNotFoundError:
+    # runs recorded before the JSON Lines log, stored as one [{"run_id", "logs"}] array
+    legacy_log = Path("logs/apps.json")
+    log_file = Path("logs/apps.jsonl")
+    if not legacy_log.exists() and not log_file.exists():
         return {"error": "Log file not found"}
-    except json.JSONDecodeError:
+    try:
+        data = orjson.loads(legacy_log.read_bytes()) if legacy_log.exists() else []
+        if not isinstance(data, list):
+            print(f"Skipping {legacy_log}: expected a JSON array of runs")
+            data = []
+        if log_file.exists():
+            # one line per log entry; group them back into runs
+            runs = {}
+            with open(log_file, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        entry = orjson.loads(line)
+                        runs.setdefault(entry.pop("run_id"), []).append(entry)
+            data += [{"run_id": run_id, "logs": logs} for run_id, logs in runs.items()]
+        # serialize once with orjson and hand FastAPI the bytes, skipping jsonable_encoder + stdlib json
+        return Response(content=orjson.dumps(data), media_type="application/json")
+    except orjson.JSONDecodeError:
         return {"error": "Log file is corrupted"}
@@ -1,53 +1,193 @@
-import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import orjson
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+class _LogWriter:
+    """
+    Owns a single append handle for a log file and writes queued records from a background thread.
+    """
+    def __init__(self, log_file: Path):
+        self._queue = queue.SimpleQueue()
+        self._fh = open(log_file, 'ab', buffering=0)
+        threading.Thread(target=self._drain, name=f"log-writer:{log_file.name}", daemon=True).start()
+
+    def put(self, record: dict):
+        self._queue.put_nowait(record)
+
+    def flush(self):
+        """
+        Block until every record queued before this call has been written and synced.
+        """
+        done = threading.Event()
+        self._queue.put_nowait(done)
+        done.wait()
+
+    def _append(self, data: bytes):
+        # several server workers may append to the same file; lock so batches never interleave
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        try:
+            self._fh.write(data)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _serialize(record: dict):
+        """
+        One JSON line for a record. Numpy values are written natively, other unknown types as str;
+        a record that still fails is dropped on its own instead of taking the batch with it.
+        """
+        try:
+            return orjson.dumps(record, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError as e:
+            print(f"Dropped unserializable log entry {record.get('step')}: {e}")
+            return None
+
+    def _drain(self):
+        while True:
+            # wait for one item, then take whatever else is already queued so it goes out in one write
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = [self._serialize(item) for item in batch if isinstance(item, dict)]
+            lines = [line for line in lines if line is not None]
+            barriers = [item for item in batch if isinstance(item, threading.Event)]
+            try:
+                if lines:
+                    self._append(b"".join(lines))
+                if barriers:
+                    os.fsync(self._fh.fileno())
+            except Exception as e:
+                print(f"Failed to write logs: {e}")
+            finally:
+                for barrier in barriers:
+                    barrier.set()
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _get_writer(log_file: Path) -> _LogWriter:
+    key = log_file.resolve()
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = _LogWriter(log_file)
+        return _writers[key]
+
 class JSONLogger:
-    def __init__(self, log_file="logs/apps.json"):
+    def __init__(self, log_file="logs/apps.jsonl"):
         self.log_file = Path(log_file)
         self.log_file.parent.mkdir(parents=True, exist_ok=True)
-        self.logs = []
-
-        if self.log_file.exists():
-            try:
-                with open(self.log_file, 'r', encoding='utf-8') as f:
-                    existing_runs = json.load(f)
-                self.run_id = len(existing_runs) + 1
-            except Exception:
-                self.run_id = 1  
-        else:
-            self.run_id = 1
+        # entries are streamed to disk as they are logged, one JSON line per entry tagged with run_id
+        self._writer = _get_writer(self.log_file)
+        # random ids stay unique across server worker processes appending to the same file
+        self.run_id = uuid.uuid4().hex
         
     def log(self, step, status, message, **kwargs):
         log_entry = {
+            "run_id": self.run_id,
             "step": step,
             "status": status, 
             "message": message,
             **kwargs
         }
-        self.logs.append(log_entry)
+        self._writer.put(log_entry)
         
         # Also print to console for immediate feedback
         status_emoji = {"SUCCESS": "✅", "ERROR": "❌", "INFO": "ℹ️", "WARNING": "⚠️"}
         print(f"{status_emoji.get(status, '📝')} [{step}] {message}")
 
     def save(self): 
-        current_run = {
-            "run_id": self.run_id,
-            "logs": self.logs
-        }
-        
-        if self.log_file.exists():
-            try:
-                with open(self.log_file, 'r', encoding='utf-8') as f:
-                    existing_runs = json.load(f)
-                if isinstance(existing_runs, list):
-                    existing_runs.append(current_run)
-                else:
-                    existing_runs = [existing_runs, current_run]
-            except Exception:
-                existing_runs = [current_run]
-        else:
-            existing_runs = [current_run]
-
-        with open(self.log_file, 'w', encoding='utf-8') as f:
-            json.dump(existing_runs, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+        # entries are already queued for the writer thread; wait until they are on disk
+        self._writer.flush()
+
+
+# persistent caches (embeddings, LLM responses, ...) live under this directory
+CACHE_DIR = Path(os.getenv("CACHE_DIR", ".cache"))
+
+class DiskCache:
+    """
+    Persistent key -> bytes store backed by SQLite. Entries are grouped by namespace so a model
+    change can invalidate its entries without touching the others. With `ttl` (seconds), entries
+    older than that are treated as missing and deleted; with `max_entries`, the oldest entries of
+    the whole file (every namespace) are deleted beyond that count.
+    """
+    def __init__(self, name, namespace, ttl=None, max_entries=None):
+        self.path = CACHE_DIR / f"{name}.sqlite3"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value BLOB, created REAL NOT NULL DEFAULT 0, PRIMARY KEY (namespace, key))"
+            )
+            # caches written before entries were timestamped
+            if "created" not in [row[1] for row in self._conn.execute("PRAGMA table_info(cache)")]:
+                self._conn.execute("ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0")
+            self._prune()
+
+    def _min_created(self):
+        return time.time() - self.ttl if self.ttl else 0
+
+    def _prune(self):
+        # called with the lock held, inside a transaction
+        if self.ttl:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND created < ?", (self.namespace, self._min_created())
+            )
+        if self.max_entries:
+            # INSERT OR REPLACE gives a rewritten entry a new rowid, so rowid order is write order
+            self._conn.execute(
+                "DELETE FROM cache WHERE rowid <= (SELECT rowid FROM cache ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def get_many(self, keys) -> dict:
+        keys = list(keys)
+        found = {}
+        min_created = self._min_created()
+        with self._lock:
+            # stay under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    "SELECT key, value FROM cache WHERE namespace = ? AND created >= ? "
+                    f"AND key IN ({','.join('?' * len(batch))})",
+                    [self.namespace, min_created, *batch]
+                )
+                found.update(rows)
+        return found
+
+    def set_many(self, items: dict):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, created) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, value, now) for key, value in items.items()]
+            )
+            self._prune()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value: bytes):
+        self.set_many({key: value})
@@ -1,12 +1,25 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.endpoints import router
+from app.services.summarize import get_transcriber, get_summarizer
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load Whisper and embedding models at startup so the first requests don't pay for it
+    for model_name in os.getenv("PRELOAD_TRANSCRIBER_MODELS", "small").split(","):
+        if model_name.strip():
+            await asyncio.to_thread(get_transcriber, model_name.strip())
+    await asyncio.to_thread(get_summarizer)
+    yield
 
 app = FastAPI(
     title="Summarize AI API",
     description="AI-powered audio/video summarization service",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware for web deployment
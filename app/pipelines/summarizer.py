@@ -1,92 +1,390 @@
+import os
 import time
-from sklearn.cluster import HDBSCAN
-from collections import defaultdict
+import asyncio
+import platform
+import random
+import hashlib
+import orjson
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import HDBSCAN, AgglomerativeClustering
+from sklearn.neighbors import NearestNeighbors
+from functools import lru_cache
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
 from langchain.text_splitter import RecursiveCharacterTextSplitter # https://python.langchain.com/docs/how_to/recursive_text_splitter/
 from sentence_transformers import SentenceTransformer # https://sbert.net/
+from app.helper import DiskCache
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# tokens embedded per chunk; MiniLM's default is 256, topic similarity holds up well at 128
+EMBEDDING_MAX_SEQ_LENGTH = 128
+# CPU embedding runtime: "onnx" (int8 ONNX Runtime), "openvino" (int8 OpenVINO) or "torch"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+CHUNK_OVERLAP = 150
+# below MIN_CLUSTER_CHUNKS everything is one topic; HDBSCAN only pays off from HDBSCAN_MIN_CHUNKS
+MIN_CLUSTER_CHUNKS = 8
+HDBSCAN_MIN_CHUNKS = 30
+# from this many chunks HDBSCAN gets a sparse k-nearest-neighbour graph instead of all N^2 distances
+SPARSE_GRAPH_MIN_CHUNKS = 1000
+KNN_NEIGHBORS = 50
+# shorter matches between neighbouring chunks are treated as coincidence, not overlap
+MIN_STITCH_OVERLAP = 20
+# a trailing chunk shorter than this is folded into the one before it instead of embedded on its own
+MIN_CHUNK_CHARS = 200
+# chunks HDBSCAN labels as noise are kept together under this id and summarized as miscellaneous
+MISC_CLUSTER_ID = -1
+
+# longer cluster texts keep their beginning and end and drop the middle before prompting
+MAX_CLUSTER_CHARS = 60_000
+
+# below this many transcript characters, map and reduce are answered by one request
+SINGLE_CALL_MAX_CHARS = 20_000
+
+# prompt templates, filled in with str.format
+CLUSTER_PROMPT = (
+    "You are a helpful assistant. Summarize the key points from the following text, "
+    "which is part of an audio transcript.{misc_note} Please provide a concise, one-sentence summary in {language}.\n"
+    "---\nTEXT:\n{text}\n---\nSUMMARY:"
+)
+BATCHED_PROMPT = (
+    "You are a helpful assistant. Each cluster below is part of an audio transcript. "
+    "For every cluster, summarize its key points in a concise, one-sentence summary in {language}.\n"
+    "{final_instruction}"
+    'Return JSON of the form {{"summaries": [{{"id": <cluster number>, "summary": "..."}}]{final_field}}} '
+    "with one entry per cluster.\n"
+    "---\n{cluster_texts}---"
+)
+BATCHED_FINAL_INSTRUCTION = (
+    "Then combine those key points into a single, coherent paragraph summarizing the whole transcript, "
+    "also in {language}.\n"
+)
+FINAL_PROMPT = (
+    "You are a professional editor. Combine the following key points from a transcript into a single, coherent paragraph. "
+    "The final summary must be in {language}.\n"
+    "---\nKEY POINTS:\n- {key_points}\n---\nFINAL SUMMARY PARAGRAPH:"
+)
+
+# Gemini responses older than this many seconds are requested again (0 keeps them forever)
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "0"))
+# entries kept on disk before the oldest are deleted (an fp16 embedding row is under 1 KB)
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000
+LLM_CACHE_MAX_ENTRIES = 10_000
+
+# retries for Gemini requests rejected with 429 (quota), waiting 1, 2, 4, ... seconds plus jitter
+RATE_LIMIT_RETRIES = 4
 
 class Summarizer:
-    def __init__(self, gemini_model):
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, gemini_model, max_concurrency=8, backend=EMBEDDING_BACKEND):
+        self.embedding_model = self._load_embedding_model(backend)
+        self.embedding_model.max_seq_length = EMBEDDING_MAX_SEQ_LENGTH
+        # embeddings differ between backends/devices/truncation, so each combination gets its own namespace
+        backend = getattr(self.embedding_model, "backend", "torch")
+        self._embedding_cache = DiskCache(
+            "embeddings",
+            f"{EMBEDDING_MODEL}:{backend}:{self.embedding_model.device.type}:{EMBEDDING_MAX_SEQ_LENGTH}",
+            max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+        )
         self.gemini_model = gemini_model
+        self._llm_cache = DiskCache(
+            "llm", getattr(gemini_model, "model_name", "gemini"), ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES
+        )
+        self.max_concurrency = max_concurrency # parallel Gemini requests, keep under the QPM quota
 
-    def chunk_text(self, text, max_chunk_size=1500):
+    @staticmethod
+    def _onnx_file_name():
         """
-        Split the transcribed text into manageable chunks.
+        Pick the int8 ONNX export of the model that matches this CPU's instruction set.
         """
-        print("Splitting text into chunks")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=max_chunk_size,
-            chunk_overlap=150,
+        if platform.machine().lower() in ("arm64", "aarch64"):
+            return "onnx/model_qint8_arm64.onnx"
+        try:
+            with open("/proc/cpuinfo") as f:
+                flags = set(next((line for line in f if line.startswith("flags")), "").split())
+        except OSError:
+            flags = set()
+        if "avx512_vnni" in flags:
+            return "onnx/model_qint8_avx512_vnni.onnx" # int8 dot products in one instruction
+        if "avx512f" in flags:
+            return "onnx/model_qint8_avx512.onnx"
+        return "onnx/model_quint8_avx2.onnx"
+
+    @staticmethod
+    def _load_embedding_model(backend=EMBEDDING_BACKEND):
+        if torch.cuda.is_available():
+            # half precision on GPU
+            return SentenceTransformer(EMBEDDING_MODEL, device="cuda", model_kwargs={"torch_dtype": torch.float16})
+        try:
+            if backend == "onnx":
+                # int8-quantized ONNX export from the model repo, run by ONNX Runtime on CPU
+                return SentenceTransformer(EMBEDDING_MODEL, device="cpu", backend="onnx",
+                                           model_kwargs={"file_name": Summarizer._onnx_file_name()})
+            if backend == "openvino":
+                # statically int8-quantized OpenVINO export, often the faster choice on Intel CPUs
+                return SentenceTransformer(EMBEDDING_MODEL, device="cpu", backend="openvino",
+                                           model_kwargs={"file_name": "openvino/openvino_model_qint8_quantized.xml"})
+        except Exception as e:
+            print(f"{backend} embedding backend unavailable, using PyTorch. Error: {e}")
+        return SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _get_splitter(chunk_size, overlap=CHUNK_OVERLAP):
+        # the splitter holds no per-call state, so one instance per size is shared across requests
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=overlap,
             length_function=len,
             is_separator_regex=False,
         )
-        chunks = text_splitter.split_text(text)
+
+    def chunk_text(self, text, max_chunk_size=1500):
+        """
+        Split the transcribed text into manageable chunks.
+        """
+        print("Splitting text into chunks")
+        chunks = self._get_splitter(max_chunk_size).split_text(text)
+        if len(chunks) > 1 and len(chunks[-1]) < MIN_CHUNK_CHARS:
+            chunks[-2:] = [self._stitch(chunks[-2:])]
+        # repeated passages (e.g. a looping intro) would only be embedded and summarized twice
+        seen = set()
+        chunks = [c for c in chunks if not ((h := hashlib.md5(c.encode("utf-8")).digest()) in seen or seen.add(h))]
         print(f"number of chunk: {len(chunks)}")
         return chunks
 
+    @staticmethod
+    def _stitch(chunks, overlap=CHUNK_OVERLAP):
+        """
+        Join chunks back into text, dropping the region a chunk shares with the end of the
+        previous one (consecutive chunks from chunk_text overlap by up to `overlap` chars).
+        """
+        out = chunks[0] if chunks else ""
+        for chunk in chunks[1:]:
+            for k in range(min(overlap, len(chunk), len(out)), MIN_STITCH_OVERLAP - 1, -1):
+                if out.endswith(chunk[:k]):
+                    out += chunk[k:]
+                    break
+            else:
+                out += " " + chunk # not neighbours in the transcript
+        return out
+
+    @classmethod
+    def _cluster_text(cls, chunks):
+        """
+        Prompt text for a cluster: its chunks stitched without overlap, middle-cut to MAX_CLUSTER_CHARS.
+        """
+        text = cls._stitch(chunks)
+        if len(text) > MAX_CLUSTER_CHARS:
+            half = MAX_CLUSTER_CHARS // 2
+            text = f"{text[:half]} [...] {text[-half:]}"
+        return text
+
+    def _embed(self, chunks):
+        """
+        Embed chunks, reusing vectors cached by content hash and encoding only the misses.
+        """
+        keys = [hashlib.sha256(chunk.encode("utf-8")).hexdigest() for chunk in chunks]
+        texts = dict(zip(keys, chunks)) # also drops repeated chunks
+        vectors = self._embedding_cache.get_many(texts)
+        missing = [key for key in texts if key not in vectors]
+        if missing:
+            # encode() already length-sorts its input internally, so each batch is padded to
+            # similar-length neighbours; a larger batch cuts per-batch overhead
+            encoded = self.embedding_model.encode(
+                [texts[key] for key in missing], batch_size=64, convert_to_numpy=True, show_progress_bar=False
+            )
+            # stored as fp16 to halve the cache size
+            new_vectors = {key: vector.astype(np.float16).tobytes() for key, vector in zip(missing, encoded)}
+            self._embedding_cache.set_many(new_vectors)
+            vectors.update(new_vectors)
+        print(f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} unique chunks reused")
+        return np.stack([np.frombuffer(vectors[key], dtype=np.float16) for key in keys]).astype(np.float32)
+
+    def _generate(self, prompt, generation_config=None):
+        """
+        generate_content() with exponential backoff while the request quota is exhausted.
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return self.gemini_model.generate_content(prompt, generation_config=generation_config).text
+            except ResourceExhausted:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = 2 ** attempt + random.uniform(0, 1)
+                print(f"Gemini rate limit hit, retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+
+    def _cached_generate(self, prompt, generation_config=None):
+        """
+        generate_content() behind a response cache keyed by the prompt hash.
+        """
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        cached = self._llm_cache.get(key)
+        if cached is not None:
+            print("LLM cache: hit")
+            return cached.decode("utf-8")
+
+        text = self._generate(prompt, generation_config)
+        self._llm_cache.set(key, text.encode("utf-8"))
+        return text
+
+    @staticmethod
+    def _knn_graph(embeddings):
+        """
+        Sparse symmetric graph of cosine distances to each chunk's KNN_NEIGHBORS nearest neighbours.
+        """
+        n = len(embeddings)
+        graph = NearestNeighbors(n_neighbors=min(KNN_NEIGHBORS, n - 1), metric='cosine').fit(embeddings) \
+            .kneighbors_graph(mode='distance')
+        graph = graph.maximum(graph.T).tocsr()
+
+        # HDBSCAN needs one connected graph. Join separate components with maximum-distance (2.0)
+        # edges; they only merge at the root of the hierarchy, so the clusters inside are unchanged.
+        n_components, labels = connected_components(graph, directed=False)
+        if n_components > 1:
+            _, roots = np.unique(labels, return_index=True)
+            bridges = csr_matrix((np.full(n_components - 1, 2.0), (np.full(n_components - 1, roots[0]), roots[1:])), shape=(n, n))
+            graph = graph.maximum(bridges).maximum(bridges.T).tocsr()
+        return graph
+
     def cluster_chunks(self, chunks):
         """
-        function to create embeddings and cluster chunks by topic using HDBSCAN.
+        function to create embeddings and cluster chunks by topic (agglomerative for few chunks, HDBSCAN otherwise).
         """
+        if len(chunks) < MIN_CLUSTER_CHUNKS:
+            print(f"{len(chunks)} chunks is below the clustering threshold, using a single cluster.")
+            return {0: list(chunks)}
+
         print("Clustering text chunks")
         start_time = time.time()
-        embeddings = self.embedding_model.encode(chunks) # Creating vector embeddings
+        embeddings = self._embed(chunks) # Creating vector embeddings
         # texts with similar meanings will be close to each other
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        if len(chunks) < SPARSE_GRAPH_MIN_CHUNKS:
+            # cosine distance for all pairs from one float32 matrix product
+            distances = 1.0 - embeddings @ embeddings.T
+            np.clip(distances, 0.0, 2.0, out=distances) # rounding can push it just below 0
+            np.fill_diagonal(distances, 0.0)
+        else:
+            distances = self._knn_graph(embeddings)
 
         # Clustering with HDBSCAN: https://scikit-learn.org/stable/modules/generated/sklearn.cluster.HDBSCAN.html
         # different from dbscan, tidak menggunakan eps (radius pencarian)
         # visualize: https://github.com/kcv-if/Modul-ML/blob/main/Modul%201/assets/DBSCAN.gif
-        clusterer = HDBSCAN(min_cluster_size=2, metric='euclidean', cluster_selection_method='eom') # matriks jarak
-        cluster_labels = clusterer.fit_predict(embeddings)
+        if len(chunks) < HDBSCAN_MIN_CHUNKS:
+            # too few points for density estimates; average linkage into a few topics, no noise label
+            clusterer = AgglomerativeClustering(n_clusters=min(4, len(chunks) // 3), metric='precomputed', linkage='average')
+        else:
+            clusterer = HDBSCAN(min_cluster_size=2, metric='precomputed', cluster_selection_method='eom') # matriks jarak
+        cluster_labels = clusterer.fit_predict(distances)
         # cluster_labels = [0, 1, 2, 1, -1, 0, 2]
 
-        clustered_chunks = defaultdict(list)
-        noise_count = 0
-        for i, label in enumerate(cluster_labels):
-            if label != -1:
-                clustered_chunks[label].append(chunks[i])
-            else:
-                noise_count += 1
-
+        # group chunk indices by label in one stable sort, so each cluster keeps transcript order
+        labels = np.asarray(cluster_labels)
+        kept = np.flatnonzero(labels != -1)
+        noise = np.flatnonzero(labels == -1)
+        order = kept[np.argsort(labels[kept], kind='stable')]
+        cluster_ids, starts = np.unique(labels[order], return_index=True)
+        clustered_chunks = {
+            int(cluster_id): [chunks[i] for i in group]
+            for cluster_id, group in zip(cluster_ids, np.split(order, starts[1:]))
+        }
         num_clusters = len(clustered_chunks)
+        # noise chunks may still hold points the summary needs; one extra cluster, added last, covers them all
+        if len(noise):
+            clustered_chunks[MISC_CLUSTER_ID] = [chunks[i] for i in noise]
+
         total_chunks = len(chunks)
-        noise_percentage = (noise_count / total_chunks) * 100 if total_chunks > 0 else 0
+        noise_percentage = (len(noise) / total_chunks) * 100 if total_chunks > 0 else 0
         
         print(f"Found {num_clusters} main topics.") 
-        print(f"Discarded as noise: {noise_count} chunks ({noise_percentage:.1f}%)")
+        print(f"Kept as miscellaneous: {len(noise)} chunks ({noise_percentage:.1f}%)")
 
-        return dict(clustered_chunks)
+        return clustered_chunks
     
-    def get_final_summary(self, clusters: dict, language="en"):
-        print("Create a summary for each cluster...")
-        cluster_summaries = []
-
-        for cluster_id, cluster_chunks in sorted(clusters.items()):
-            full_cluster_text = " ".join(cluster_chunks)
-            prompt = (
-                f"You are a helpful assistant. Summarize the key points from the following text, "
-                f"which is part of an audio transcript. Please provide a concise, one-sentence summary in {language}.\n"
-                f"---\nTEXT:\n{full_cluster_text}\n---\nSUMMARY:"
-            )            
+    async def _summarize_cluster(self, semaphore, cluster_id, cluster_chunks, language):
+        full_cluster_text = self._cluster_text(cluster_chunks)
+        misc_note = " It collects stray passages that fit no single topic." if cluster_id == MISC_CLUSTER_ID else ""
+        prompt = CLUSTER_PROMPT.format(misc_note=misc_note, language=language, text=full_cluster_text)
+        async with semaphore:
             try:
-                response = self.gemini_model.generate_content(prompt)
-                cluster_summaries.append(response.text)
+                # the sync client runs on a worker thread so the requests overlap
+                summary = await asyncio.to_thread(
+                    self._cached_generate, prompt
+                )
                 print(f"Summary for Cluster {cluster_id} completed.")
+                return summary
             except Exception as e:
                 print(f"Failed to summarize Cluster {cluster_id}. Error: {e}")
+                return None
+
+    async def _summarize_clusters(self, clusters: dict, language):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[
+            self._summarize_cluster(semaphore, cluster_id, cluster_chunks, language)
+            for cluster_id, cluster_chunks in clusters.items()
+        ])
+        return [summary for summary in results if summary is not None]
+
+    def _summarize_clusters_batched(self, clusters: dict, language, with_final=False):
+        """
+        Summarize every cluster in one JSON-mode request; with_final also asks for the combined
+        paragraph in the same response. Returns (cluster summaries, final summary or None), or
+        None if the response doesn't hold exactly one summary per cluster.
+        """
+        cluster_texts = "".join(
+            f"CLUSTER {i}{' (miscellaneous: stray passages that fit no single topic)' if cluster_id == MISC_CLUSTER_ID else ''}:\n"
+            f"{self._cluster_text(cluster_chunks)}\n\n"
+            for i, (cluster_id, cluster_chunks) in enumerate(clusters.items())
+        )
+        final_instruction, final_field = "", ""
+        if with_final:
+            final_instruction = BATCHED_FINAL_INSTRUCTION.format(language=language)
+            final_field = ', "final_summary": "..."'
+        prompt = BATCHED_PROMPT.format(
+            language=language, final_instruction=final_instruction, final_field=final_field, cluster_texts=cluster_texts
+        )
+        try:
+            response = orjson.loads(self._cached_generate(
+                prompt, generation_config={"response_mime_type": "application/json"}
+            ))
+            summaries = {item["id"]: item["summary"] for item in response["summaries"]}
+            if sorted(summaries) != list(range(len(clusters))):
+                raise ValueError(f"expected {len(clusters)} summaries, got ids {sorted(summaries)}")
+            return [summaries[i] for i in range(len(clusters))], response.get("final_summary")
+        except Exception as e:
+            print(f"Batched cluster summary failed. Error: {e}")
+            return None
+
+    def get_final_summary(self, clusters: dict, language="en"):
+        result = None
+        # Small transcript: cluster summaries and the final paragraph from a single request
+        if sum(len(chunk) for cluster_chunks in clusters.values() for chunk in cluster_chunks) < SINGLE_CALL_MAX_CHARS:
+            print("Create cluster summaries and the final summary in one request...")
+            result = self._summarize_clusters_batched(clusters, language, with_final=True)
+            if result is not None and result[1]:
+                return result
+
+        if result is None:
+            print("Create a summary for each cluster...")
+            # Map stage: a single request for all clusters; order follows the clusters dict (topics, then miscellaneous)
+            result = self._summarize_clusters_batched(clusters, language) if len(clusters) > 1 else None
+        if result is not None:
+            cluster_summaries = result[0]
+        else:
+            # one Gemini request per cluster, issued concurrently
+            cluster_summaries = asyncio.run(self._summarize_clusters(clusters, language))
 
         # Reduce Stage
         print("\nCombining all summaries into one...")
         all_summaries_text = "\n".join(cluster_summaries)
-        final_prompt = (
-            f"You are a professional editor. Combine the following key points from a transcript into a single, coherent paragraph. "
-            f"The final summary must be in {language}.\n"
-            f"---\nKEY POINTS:\n- {all_summaries_text}\n---\nFINAL SUMMARY PARAGRAPH:"
-        )
+        final_prompt = FINAL_PROMPT.format(language=language, key_points=all_summaries_text)
         try:
-            final_response = self.gemini_model.generate_content(final_prompt)
-            return cluster_summaries, final_response.text
+            final_summary = self._cached_generate(final_prompt)
+            return cluster_summaries, final_summary
         except Exception as e:
             print(f"Failed to create final summary. Error: {e}")
             return cluster_summaries, "Failed to generate final summary."
\ No newline at end of file
@@ -1,19 +1,68 @@
-import whisper
 import time
+import torch
+import hashlib
+import orjson
+import numpy as np
+from pathlib import Path
+from faster_whisper import WhisperModel, BatchedInferencePipeline # https://github.com/SYSTRAN/faster-whisper
+from app.helper import DiskCache
+
+# 30 s windows decoded together per encoder/decoder pass; a GPU has the memory and parallelism for more
+TRANSCRIBE_BATCH_SIZE_GPU = 16
+TRANSCRIBE_BATCH_SIZE_CPU = 8
+
+# files up to this size are hashed whole; larger ones by size plus their first and last HASH_SPAN bytes
+FULL_HASH_LIMIT = 64 << 20
+HASH_SPAN = 4 << 20
+# transcripts kept on disk before the oldest are deleted
+TRANSCRIPT_CACHE_MAX_ENTRIES = 1_000
+
+def _audio_key(audio) -> str:
+    """
+    Content key for a transcription input: a file path or an in-memory sample array.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(audio, np.ndarray):
+        digest.update(np.ascontiguousarray(audio).data)
+        return digest.hexdigest()
+    size = Path(audio).stat().st_size
+    digest.update(str(size).encode())
+    with open(audio, "rb") as f:
+        if size <= FULL_HASH_LIMIT:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(HASH_SPAN))
+            f.seek(-HASH_SPAN, 2)
+            digest.update(f.read())
+    return digest.hexdigest()
 
 class Transcriber:
     """
-    transcribe audio using OpenAI Whisper.
+    transcribe audio using Whisper on CTranslate2 (faster-whisper).
     """
     def __init__(self, model_name="small", gemini_model=None):
-        print(f"load whisper model: '{model_name}'")
         start_time = time.time()
-        self.model = whisper.load_model(model_name)
+        # int8 weights (about a quarter of the fp32 memory); activations stay fp16 on GPU
+        if torch.cuda.is_available():
+            device, compute_type, self.batch_size = "cuda", "int8_float16", TRANSCRIBE_BATCH_SIZE_GPU
+        else:
+            device, compute_type, self.batch_size = "cpu", "int8", TRANSCRIBE_BATCH_SIZE_CPU
+        print(f"load whisper model: '{model_name}' on {device} ({compute_type}, batch size {self.batch_size})")
+        self.model = WhisperModel(model_name, device=device, compute_type=compute_type)
+        # VAD splits the audio at pauses and drops silence; the speech windows are then batched
+        self.pipeline = BatchedInferencePipeline(model=self.model)
         self.gemini_model = gemini_model
+        # transcripts differ per model and decoding setup, so each gets its own namespace
+        self._cache = DiskCache(
+            "transcripts", f"{model_name}:batch{self.batch_size}:vad", max_entries=TRANSCRIPT_CACHE_MAX_ENTRIES
+        )
         print(f"model successfully loaded in {time.time() - start_time:.2f} seconds.")
 
     def transcribe(self, file_path, language=None):
-        print(f"start transcribing: {file_path}")
+        """
+        file_path may also be a mono float32 numpy array sampled at 16 kHz.
+        """
+        print(f"start transcribing: {file_path if isinstance(file_path, (str, Path)) else 'in-memory audio'}")
         if language:
             print(f"Forcing transcription in language: {language}")
         else:
@@ -21,12 +70,29 @@ class Transcriber:
 
         start_time = time.time()
         try:
-            options = {"language": language} if language else {}
-            result = self.model.transcribe(str(file_path),  **options) 
-            
+            audio = str(file_path) if isinstance(file_path, Path) else file_path
+            key = f"{_audio_key(audio)}:{language or 'auto'}"
+            cached = self._cache.get(key)
+            if cached is not None:
+                result = orjson.loads(cached)
+                print(f"Transcript cache hit, detected language: {result['language']}")
+                return result["text"], result["language"]
+
+            segments, info = self.pipeline.transcribe(
+                audio,
+                language=language,
+                beam_size=5,
+                batch_size=self.batch_size,
+                vad_filter=True,
+                vad_parameters=dict(min_silence_duration_ms=500)
+            )
+            # segments is a generator; decoding happens while it is consumed
+            text = "".join(segment.text for segment in segments).strip()
+
             print(f"transcribed {time.time() - start_time:.2f} seconds.")
-            print(f"Detected language: {result['language']}")
-            return result['text'], result['language']
+            print(f"Detected language: {info.language}")
+            self._cache.set(key, orjson.dumps({"text": text, "language": info.language}))
+            return text, info.language
         except FileNotFoundError:
             print(f"Error: File '{file_path}' not found.")
             return None
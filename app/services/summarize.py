@@ -1,9 +1,12 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 import google.generativeai as genai
 
-from app.pipelines.converter import convert_video_to_audio, convert_audio_format
+from app.pipelines.converter import load_audio, is_standard_wav
 from app.pipelines.transcriber import Transcriber
 from app.pipelines.summarizer import Summarizer
 from app.pipelines.preprocessor import enhance_audio
@@ -23,6 +26,76 @@ except Exception as e:
     print(f"FATAL: Gemini model initialization failed: {e}")
     exit(1)
 
+# Whisper sizes a request may ask for; faster-whisper would download any other name from the Hugging Face Hub
+TRANSCRIBER_MODELS = {
+    "tiny", "tiny.en", "base", "base.en", "small", "small.en", "medium", "medium.en",
+    "large-v1", "large-v2", "large-v3", "large", "turbo", "large-v3-turbo",
+}
+# loaded Whisper models kept in memory, least recently used is dropped first
+MAX_LOADED_TRANSCRIBERS = max(1, int(os.getenv("MAX_LOADED_TRANSCRIBERS", "2")))
+
+_transcribers = OrderedDict()
+# guards the LRU dict only; loading happens under a per-model lock so loaded models stay available
+_transcribers_lock = threading.Lock()
+_transcriber_load_locks = {}
+
+def _cached_transcriber(model_name: str):
+    with _transcribers_lock:
+        if model_name in _transcribers:
+            _transcribers.move_to_end(model_name)
+            return _transcribers[model_name]
+        return None
+
+def get_transcriber(model_name: str) -> Transcriber:
+    """
+    Return the Transcriber for model_name, loading the Whisper weights only once per process.
+    """
+    if model_name not in TRANSCRIBER_MODELS:
+        raise ValueError(f"Unsupported transcriber model: {model_name}")
+    transcriber = _cached_transcriber(model_name)
+    if transcriber is not None:
+        return transcriber
+    with _transcribers_lock:
+        load_lock = _transcriber_load_locks.setdefault(model_name, threading.Lock())
+    with load_lock:
+        # another request may have finished loading it while this one waited
+        transcriber = _cached_transcriber(model_name)
+        if transcriber is not None:
+            return transcriber
+        transcriber = Transcriber(model_name=model_name, gemini_model=gemini_model)
+        with _transcribers_lock:
+            _transcribers[model_name] = transcriber
+            while len(_transcribers) > MAX_LOADED_TRANSCRIBERS:
+                # runs still using the evicted model keep their own reference until they finish
+                _transcribers.popitem(last=False)
+        return transcriber
+
+_summarizer = None
+_summarizer_lock = threading.Lock()
+
+def get_summarizer() -> Summarizer:
+    """
+    Return the shared Summarizer, loading the embedding model only once per process.
+    """
+    global _summarizer
+    with _summarizer_lock:
+        if _summarizer is None:
+            _summarizer = Summarizer(gemini_model=gemini_model)
+        return _summarizer
+
+# loads models in the background while a run is still decoding/enhancing audio
+_warmup_executor = ThreadPoolExecutor(max_workers=1)
+
+def _warm_up_models(transcriber_model: str):
+    """
+    Start loading any model that isn't loaded yet. get_transcriber()/get_summarizer() return the
+    loaded instance, waiting on their lock if loading is still in progress.
+    """
+    if transcriber_model in TRANSCRIBER_MODELS and transcriber_model not in _transcribers:
+        _warmup_executor.submit(get_transcriber, transcriber_model)
+    if _summarizer is None:
+        _warmup_executor.submit(get_summarizer)
+
 def run_pipeline(
     input_file: Path,
     denoise: bool = False,
@@ -33,7 +106,42 @@ def run_pipeline(
     language: str = None
 ) -> dict:
     logger = JSONLogger()
+    created = []  # intermediate files written by this run; only these are removed afterwards
+    try:
+        return _run_pipeline(
+            logger,
+            created,
+            input_file,
+            denoise=denoise,
+            aggressive_denoise=aggressive_denoise,
+            force_wav=force_wav,
+            transcriber_model=transcriber_model,
+            chunk_size=chunk_size,
+            language=language
+        )
+    finally:
+        _remove_files(logger, created)
+
+def _remove_files(logger: JSONLogger, files: list):
+    try:
+        for file in files:
+            file.unlink(missing_ok=True)
+    except Exception as e:
+        logger.log("CLEANUP", "WARNING", f"Failed to clean up temporary files: {e}")
+
+def _run_pipeline(
+    logger: JSONLogger,
+    created: list,
+    input_file: Path,
+    denoise: bool = False,
+    aggressive_denoise: bool = False,
+    force_wav: bool = False,
+    transcriber_model: str = "small",
+    chunk_size: int = 2000,
+    language: str = None
+) -> dict:
     audio_path = None
+    audio = None  # decoded samples, when the input is transcribed from memory
 
     type_supported = [".mp4", ".mkv", ".mov", ".mp3", ".wav", ".m4a", ".flac", ".ogg"]
     logger.log("INITIALIZATION", "INFO", "Starting audio/video processing pipeline", 
@@ -52,32 +160,38 @@ def run_pipeline(
         return {"error": f"Unsupported file type: {input_type}"}
 
     logger.log("FILE_VALIDATION", "SUCCESS", "Input file validated", file_type=input_type)
+    # model loading doesn't depend on the audio, so overlap it with conversion and enhancement
+    _warm_up_models(transcriber_model)
     logger.log("AUDIO_CONVERSION", "INFO", "Starting audio format standardization")
     
     if input_type in [".mp4", ".mkv", ".mov"]:
         logger.log("VIDEO_PROCESSING", "INFO", f"Processing video file: '{input_file.name}'")
-        output_dir = Path("./data/audio")
-        output_dir.mkdir(parents=True, exist_ok=True)
-        audio_path = output_dir / f"{input_file.stem}.wav"
-        result = convert_video_to_audio(input_file, audio_path)
-
-        if result is None:
-            logger.log("VIDEO_PROCESSING", "ERROR", "Video conversion failed")
-            return {"error": "Video conversion failed"}
-        logger.log("VIDEO_PROCESSING", "SUCCESS", "Video converted to audio", output_file=str(audio_path))
+        audio_path = input_file
+        if denoise or aggressive_denoise:
+            # enhancement decodes the audio track itself, so no intermediate WAV is written
+            logger.log("VIDEO_PROCESSING", "INFO", "Audio track will be extracted during enhancement")
+        else:
+            # FFmpeg demuxes, downmixes and resamples straight into memory
+            audio, _ = load_audio(input_file)
+            if audio is None:
+                logger.log("VIDEO_PROCESSING", "ERROR", "Video conversion failed")
+                return {"error": "Video conversion failed"}
+            logger.log("VIDEO_PROCESSING", "SUCCESS", "Audio track extracted in memory", num_samples=len(audio))
 
     elif input_type in [".mp3", ".wav", ".m4a", ".flac", ".ogg"]:
         logger.log("AUDIO_PROCESSING", "INFO", f"Processing audio file: '{input_file.name}'")
-        if input_type != ".wav" or force_wav:
-            output_dir = Path("./data/audio")
-            output_dir.mkdir(parents=True, exist_ok=True)
-            audio_path = output_dir / f"{input_file.stem}_standardized.wav"
-            result = convert_audio_format(input_file, audio_path)
-            if result is None:
+        if denoise or aggressive_denoise:
+            # enhancement decodes the file itself, so no standardized copy is written first
+            audio_path = input_file
+            logger.log("AUDIO_PROCESSING", "INFO", "Audio will be standardized during enhancement")
+        elif input_type != ".wav" or (force_wav and not is_standard_wav(input_file)):
+            # decode straight into memory; the transcriber takes the array, so no intermediate WAV is written
+            audio_path = input_file
+            audio, _ = load_audio(input_file)
+            if audio is None:
                 logger.log("AUDIO_PROCESSING", "WARNING", "Audio format conversion failed. Using original file.")
-                audio_path = input_file
             else:
-                logger.log("AUDIO_PROCESSING", "SUCCESS", "Audio format standardized", output_file=str(audio_path))
+                logger.log("AUDIO_PROCESSING", "SUCCESS", "Audio format standardized in memory", num_samples=len(audio))
         else:
             audio_path = input_file
             logger.log("AUDIO_PROCESSING", "INFO", f"Using WAV file directly: {audio_path.name}")
@@ -91,17 +205,59 @@ def run_pipeline(
         enhanced_audio_path = enhance_audio(audio_path, aggressive_mode=aggressive_denoise)
         if enhanced_audio_path:
             audio_path = enhanced_audio_path
+            created.append(audio_path)
             logger.log("AUDIO_ENHANCEMENT", "SUCCESS", "Audio enhancement completed")
         else:
             logger.log("AUDIO_ENHANCEMENT", "ERROR", "Audio enhancement failed. Proceeding with original audio.")
     else:
         logger.log("AUDIO_ENHANCEMENT", "INFO", "Audio enhancement skipped by user choice")
 
+    return _transcribe_and_summarize(
+        logger,
+        audio if audio is not None else audio_path,
+        audio_path.name,
+        transcriber_model=transcriber_model,
+        chunk_size=chunk_size,
+        language=language
+    )
+
+def run_pipeline_from_array(
+    audio,
+    source_name: str = "upload",
+    transcriber_model: str = "small",
+    chunk_size: int = 2000,
+    language: str = None
+) -> dict:
+    """
+    Run transcription and summarization on audio that is already decoded to 16 kHz mono float32.
+    """
+    logger = JSONLogger()
+    logger.log("INITIALIZATION", "INFO", "Starting pipeline from decoded audio",
+               input_file=source_name,
+               transcriber_model=transcriber_model,
+               num_samples=len(audio))
+    return _transcribe_and_summarize(
+        logger,
+        audio,
+        source_name,
+        transcriber_model=transcriber_model,
+        chunk_size=chunk_size,
+        language=language
+    )
+
+def _transcribe_and_summarize(
+    logger: JSONLogger,
+    audio,
+    audio_name: str,
+    transcriber_model: str = "small",
+    chunk_size: int = 2000,
+    language: str = None
+) -> dict:
     # transcription and summarization api calls
     logger.log("MODEL_INIT", "INFO", "Initializing AI models")
     try:
-        transcriber = Transcriber(model_name=transcriber_model, gemini_model=gemini_model)
-        summarizer = Summarizer(gemini_model=gemini_model)
+        transcriber = get_transcriber(transcriber_model)
+        summarizer = get_summarizer()
         logger.log("MODEL_INIT", "SUCCESS", "AI models initialized successfully")
     except Exception as e:
         logger.log("MODEL_INIT", "ERROR", f"Initialization error: {e}")
@@ -111,8 +267,8 @@ def run_pipeline(
         language = None
 
     # transcription 
-    logger.log("TRANSCRIPTION", "INFO", f"Starting transcription of: {audio_path.name}")
-    result, detected_language = transcriber.transcribe(audio_path, language=language)
+    logger.log("TRANSCRIPTION", "INFO", f"Starting transcription of: {audio_name}")
+    result, detected_language = transcriber.transcribe(audio, language=language)
     if result:
         logger.log("TRANSCRIPTION", "SUCCESS", "Transcription completed",
                    detected_language=detected_language,
@@ -132,14 +288,12 @@ def run_pipeline(
                chunk_size=chunk_size)
 
     # clustering
-    if len(chunks) > 7:
-        logger.log("CLUSTERING", "INFO", "Clustering chunks by topic")
-        clusters = summarizer.cluster_chunks(chunks)
-        logger.log("CLUSTERING", "SUCCESS", "Topic clustering completed",
-                   num_clusters=len(clusters))
-    else:
-        clusters = {0: chunks}
-        logger.log("CLUSTERING", "INFO", "Few Chunks - no clustering needed")
+    # below MIN_CLUSTER_CHUNKS chunks this is a single cluster and the embedding model is never called
+    # (the LLM cache is keyed by prompt hash, not by embeddings)
+    logger.log("CLUSTERING", "INFO", "Clustering chunks by topic")
+    clusters = summarizer.cluster_chunks(chunks)
+    logger.log("CLUSTERING", "SUCCESS", "Topic clustering completed",
+               num_clusters=len(clusters))
 
     #summarization
     logger.log("SUMMARIZATION", "INFO", "Generating comprehensive summary")
@@ -150,16 +304,6 @@ def run_pipeline(
     logger.log("PIPELINE_COMPLETE", "SUCCESS", "Pipeline completed successfully")
     logger.save()
 
-    temp_folders  = [Path("data/audio/enhanced"), Path("data/temp"), Path("data/audio")]
-    for folder in temp_folders:
-        try:
-            if folder.exists():
-                for file in folder.rglob("*"):
-                    if file.is_file():
-                        file.unlink()
-        except Exception as e:
-            logger.log("CLEANUP", "WARNING", f"Failed to clean up {folder}: {e}")
-
     return {
         "summary": final_summary,
         "transcript": transcript,